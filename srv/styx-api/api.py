@@ -13,9 +13,10 @@ from pydantic import BaseModel
 from typing import Optional
 
 class TrafficAPI:
-    def __init__(self, database_path: str):
+    def __init__(self, database_path: str, stage_path: Optional[str] = None):
         self.app = FastAPI()
         self.database_path = database_path
+        self.stage_path = stage_path
         self.setup_routes()
 
     class TrafficTotals(BaseModel):
@@ -39,6 +40,19 @@ class TrafficAPI:
     def query_database(self, query: str, params: tuple):
         conn = sqlite3.connect(self.database_path)
         cursor = conn.cursor()
+        if self.stage_path and os.path.exists(self.stage_path):
+            # Present traffic not yet compacted by styx-dpi alongside the persistent
+            # rows; the temporary view takes precedence over main.traffic
+            cursor.execute("ATTACH DATABASE ? AS stage", (self.stage_path,))
+            # styx-dpi creates the file before the table, so it may not exist yet
+            cursor.execute("SELECT 1 FROM stage.sqlite_master WHERE type = 'table' AND name = 'traffic'")
+            if cursor.fetchone():
+                cursor.execute('''
+                    CREATE TEMP VIEW traffic AS
+                    SELECT * FROM main.traffic
+                    UNION ALL
+                    SELECT * FROM stage.traffic
+                ''')
         cursor.execute(query, params)
         result = cursor.fetchall()
         conn.close()
@@ -345,6 +359,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Report network traffic.")
     parser.add_argument('--db_path', default=os.getenv('DB_PATH', '../styx-dpi/data/styx-dpi.db'), help='Path to SQLite3 database (default: data/styx-dpi.db)')
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
+    parser.add_argument('--stage_path', default=os.getenv('STAGE_PATH'), help='Path to SQLite3 staging database written by styx-dpi (default: disabled)')
     parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'), help='Address to listen for connections')
     parser.add_argument('--port', default=int(os.getenv('PORT', '8192')), help='Port to listen for connections')
     args = parser.parse_args()
@@ -356,5 +371,5 @@ if __name__ == "__main__":
         except ModuleNotFoundError as e:
             print("IntelliJ debugger not available")
 
-    api = TrafficAPI(database_path=args.db_path)
+    api = TrafficAPI(database_path=args.db_path, stage_path=args.stage_path)
     uvicorn.run(api.app, host=args.host, port=args.port)
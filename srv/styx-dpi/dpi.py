@@ -7,18 +7,35 @@ import ipaddress
 import netifaces
 import os
 import re
+import signal
 import socket
 import sqlite3
 import subprocess
+import sys
 import time
 from collections import defaultdict
 from datetime import datetime
 from threading import Thread
 
 class NetworkMonitor:
-    def __init__(self, interface='wlan0', db_path='data/styx-dpi.db', log_path='/app/log/pihole.log', new_db=False, debug=False):
+    def __init__(self, interface='wlan0', db_path='data/styx-dpi.db', log_path='/app/log/pihole.log', new_db=False, debug=False,
+                 stage_path=None, compact_interval=300, compact_resolution=60):
         self.interface = interface
         self.db_path = db_path
+        # Optional staging database (on tmpfs) receiving the per-second rows, which are
+        # periodically compacted into db_path. On power loss or other unclean shutdown,
+        # up to compact_interval + compact_resolution seconds of traffic may be lost.
+        self.stage_path = stage_path
+        self.compact_interval = compact_interval
+        self.compact_resolution = compact_resolution
+        if self.stage_path:
+            try:
+                self.compact_interval = int(compact_interval)
+                self.compact_resolution = int(compact_resolution)
+            except (TypeError, ValueError):
+                raise ValueError("Compaction interval and resolution must be whole numbers of seconds.")
+            if self.compact_interval <= 0 or self.compact_resolution <= 0:
+                raise ValueError("Compaction interval and resolution must be positive numbers of seconds.")
         self.log_path = log_path
         self.new_db = new_db
         self.debug = debug
@@ -47,15 +64,21 @@ class NetworkMonitor:
             raise ValueError(f"Could not determine IP range for interface {interface}: {ve}")
 
     def _setup_database(self):
-        if self.new_db:
-            if os.path.exists(self.db_path):
-                os.remove(self.db_path)
-            self._create_database()
-        elif not os.path.exists(self.db_path):
-            self._create_database()
-
-    def _create_database(self):
-        conn = sqlite3.connect(self.db_path)
+        db_paths = [self.db_path]
+        if self.stage_path:
+            db_paths.append(self.stage_path)
+
+        for db_path in db_paths:
+            if self.new_db:
+                if os.path.exists(db_path):
+                    os.remove(db_path)
+                self._create_database(db_path)
+            elif not os.path.exists(db_path):
+                self._create_database(db_path)
+
+    @staticmethod
+    def _create_database(db_path):
+        conn = sqlite3.connect(db_path)
         c = conn.cursor()
         c.execute('''
             CREATE TABLE IF NOT EXISTS traffic (
@@ -137,7 +160,7 @@ class NetworkMonitor:
             return None
 
     def monitor_network_traffic(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.stage_path or self.db_path)
         c = conn.cursor()
 
         tcpdump_cmd = f"tcpdump -i {self.interface} -n -l"
@@ -197,8 +220,17 @@ class NetworkMonitor:
                     self.traffic_data[key]['domain'] = domain
 
                 if time.time() - start_time >= 1:
-                    self._insert_traffic_data(c)
-                    self.traffic_data.clear()
+                    try:
+                        self._insert_traffic_data(c)
+                        self.traffic_data.clear()
+                    except sqlite3.OperationalError as db_e:
+                        # Keep this batch for the next insert, e.g. while compaction holds the lock
+                        conn.rollback()
+                        if 'database is locked' in str(db_e):
+                            if self.debug:
+                                print(f"DEBUG: Deferred traffic insert: {db_e}")
+                        else:
+                            print(f"Failed to insert traffic data: {db_e}")
                     start_time = time.time()
 
         conn.close()
@@ -218,17 +250,90 @@ class NetworkMonitor:
             ''', (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), local_ip, remote_ip, int(port), data['sent'], data['received'], data['domain']))
         cursor.connection.commit()
 
+    def compact_staged_traffic(self):
+        while True:
+            try:
+                self._compact_staged_traffic()
+            except Exception as compact_e:
+                # Staged rows are left in place and retried on the next pass
+                print(f"Failed to compact staged traffic: {compact_e}")
+            time.sleep(self.compact_interval)
+
+    def _compact_staged_traffic(self, final=False):
+        # Only merge buckets which have completely elapsed, so that each
+        # (bucket, local, remote, port, domain) is normally written to the database once.
+        # If the clock steps backwards (e.g. NTP sync at boot) a bucket may be
+        # written again as a separate row, which still sums correctly.
+        # The final pass on shutdown merges every staged row, including the current bucket.
+        resolution = self.compact_resolution
+        if final:
+            cutoff = datetime.max.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            cutoff = datetime.utcfromtimestamp(int(time.time()) // resolution * resolution).strftime('%Y-%m-%d %H:%M:%S')
+
+        # Both databases are modified within a single transaction, so readers
+        # attaching the staging database never see rows counted twice or missing.
+        # The persistent database is opened as main so that SQLite writes the
+        # super-journal for the commit alongside it rather than onto tmpfs.
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            conn.execute('ATTACH DATABASE ? AS stage', (self.stage_path,))
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                c = conn.execute('''
+                    INSERT INTO main.traffic (timestamp, local, remote, port, sent, received, domain)
+                    SELECT
+                        strftime('%Y-%m-%d %H:%M:%S', CAST(strftime('%s', timestamp) AS INTEGER) / ? * ?, 'unixepoch') AS bucket,
+                        local,
+                        remote,
+                        port,
+                        SUM(sent),
+                        SUM(received),
+                        domain
+                    FROM stage.traffic
+                    WHERE timestamp < ?
+                    GROUP BY bucket, local, remote, port, domain
+                ''', (resolution, resolution, cutoff))
+                conn.execute('DELETE FROM stage.traffic WHERE timestamp < ?', (cutoff,))
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+
+            if self.debug:
+                print(f"DEBUG: Compacted staged traffic before {cutoff} into {c.rowcount} rows")
+        finally:
+            conn.close()
+
+    def _shutdown(self, signum, frame):
+        # Merge all staged traffic so that a clean stop or reboot loses no data
+        try:
+            self._compact_staged_traffic(final=True)
+        except Exception as compact_e:
+            print(f"Failed to compact staged traffic on shutdown: {compact_e}")
+        sys.exit(0)
+
     def start(self):
+        # Worker threads are daemons so that the process can exit from the shutdown handler
         # Create and start the pihole log parsing thread
-        pihole_thread = Thread(target=self.update_ip_to_domain)
+        pihole_thread = Thread(target=self.update_ip_to_domain, daemon=True)
         pihole_thread.start()
 
         # Create and start the network monitoring thread
-        traffic_thread = Thread(target=self.monitor_network_traffic)
+        traffic_thread = Thread(target=self.monitor_network_traffic, daemon=True)
         traffic_thread.start()
 
-        pihole_thread.join()
-        traffic_thread.join()
+        threads = [pihole_thread, traffic_thread]
+
+        # Create and start the staging compaction thread
+        if self.stage_path:
+            signal.signal(signal.SIGTERM, self._shutdown)
+            compact_thread = Thread(target=self.compact_staged_traffic, daemon=True)
+            compact_thread.start()
+            threads.append(compact_thread)
+
+        for thread in threads:
+            thread.join()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Monitor network traffic and DNS resolutions.")
@@ -237,6 +342,9 @@ if __name__ == "__main__":
     parser.add_argument('--interface', default=os.getenv('INTERFACE', 'wlan0'), help='Network interface to monitor (default: wlan0)')
     parser.add_argument('--log_path', default=os.getenv('LOG_PATH', '/app/log/pihole.log'), help='Path to Pi-hole log (default: /app/log/pihole.log)')
     parser.add_argument('--new-db', action='store_true', help='Create a new database, overwriting any existing one')
+    parser.add_argument('--stage_path', default=os.getenv('STAGE_PATH'), help='Path to SQLite3 staging database on tmpfs, enables staged ingest (default: disabled)')
+    parser.add_argument('--compact_interval', default=os.getenv('COMPACT_INTERVAL') or '300', help='Seconds between merges of staged traffic into the database (default: 300)')
+    parser.add_argument('--compact_resolution', default=os.getenv('COMPACT_RESOLUTION') or '60', help='Seconds of traffic aggregated into each merged row (default: 60)')
     args = parser.parse_args()
 
     if args.debug:
@@ -246,5 +354,6 @@ if __name__ == "__main__":
         except ModuleNotFoundError as e:
             print("IntelliJ debugger not available")
 
-    monitor = NetworkMonitor(interface=args.interface, db_path=args.db_path, log_path=args.log_path, new_db=args.new_db, debug=args.debug)
+    monitor = NetworkMonitor(interface=args.interface, db_path=args.db_path, log_path=args.log_path, new_db=args.new_db, debug=args.debug,
+                             stage_path=args.stage_path, compact_interval=args.compact_interval, compact_resolution=args.compact_resolution)
     monitor.start()